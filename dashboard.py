@@ -2,9 +2,19 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
+from decimal import Decimal
 from databricks import sql
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import atexit
+import functools
 import json
+import orjson
 import os
+import queue
+import threading
+import time
 from dotenv import load_dotenv
 
 # Carregar variáveis de ambiente
@@ -17,7 +27,7 @@ st.set_page_config(
     layout="wide"
 )
 
-# CSS customizado (com melhorias para badges)
+# CSS customizado
 st.markdown("""
 <style>
     body, .main, .block-container {
@@ -58,30 +68,6 @@ st.markdown("""
         font-weight: bold;
         color: white;
     }
-    
-    .status-badge {
-        padding: 4px 8px;
-        border-radius: 12px;
-        font-size: 0.8rem;
-        font-weight: bold;
-        text-align: center;
-        display: inline-block;
-    }
-    
-    .status-em-estoque {
-        background-color: #10b981;
-        color: white;
-    }
-    
-    .status-sem-estoque {
-        background-color: #ef4444;
-        color: white;
-    }
-    
-    .status-estoque-baixo {
-        background-color: #f59e0b;
-        color: white;
-    }
 </style>
 """, unsafe_allow_html=True)
 
@@ -90,6 +76,18 @@ DATABRICKS_HOSTNAME = os.getenv('DATABRICKS_HOSTNAME')
 HTTP_PATH = os.getenv('DATABRICKS_HTTP_PATH')
 ACCESS_TOKEN = os.getenv('DATABRICKS_ACCESS_TOKEN')
 
+# Teto de produtos da interface: as queries trazem esse ranking uma vez e o top N é recortado localmente
+MAX_TOP_N = 100
+
+# Os dados do Databricks mudam de hora em hora: cada janela desse tamanho gera uma entrada de cache nova
+CACHE_TTL_SECONDS = 3600
+
+# Chamadas abaixo desse tempo são contadas como acerto de cache nas estatísticas da barra lateral
+CACHE_HIT_THRESHOLD_S = 0.005
+
+# Troca "," <-> "." para exibir valores no padrão brasileiro (R$ 1.234,56)
+BRL_SEPARADORES = str.maketrans(',.', '.,')
+
 # Verificar se as credenciais foram carregadas
 if not all([DATABRICKS_HOSTNAME, HTTP_PATH, ACCESS_TOKEN]):
     st.error("""
@@ -102,212 +100,284 @@ if not all([DATABRICKS_HOSTNAME, HTTP_PATH, ACCESS_TOKEN]):
     """)
     st.stop()
 
-@st.cache_resource
-def get_databricks_connection():
-    """Cria conexão com Databricks"""
-    try:
+class _Pool:
+    """Mantém conexões Databricks abertas entre execuções e só reconecta quando o ping falha"""
+
+    def __init__(self, max_idle=2):
+        self._idle = queue.LifoQueue(maxsize=max_idle)
+
+    def _connect(self):
         return sql.connect(
             server_hostname=DATABRICKS_HOSTNAME,
             http_path=HTTP_PATH,
             access_token=ACCESS_TOKEN
         )
-    except Exception as e:
-        st.error(f"Erro ao conectar: {e}")
-        return None
 
-# NOVA FUNÇÃO: Obter total de produtos únicos
-@st.cache_data(ttl=300)
-def get_total_products():
-    """Obtém o total de produtos únicos nos dados"""
-    connection = get_databricks_connection()
-    if not connection:
-        return 10
-    
-    try:
-        query = """
-        SELECT COUNT(DISTINCT TRIM(descricaoProduto)) as total_produtos
-        FROM main.default.itens_venda_mm
-        WHERE descricaoProduto IS NOT NULL
-        AND LENGTH(TRIM(descricaoProduto)) > 0
-        AND qtde > 0
-        """
-        
-        df = pd.read_sql(query, connection)
-        if not df.empty:
-            return int(df.iloc[0]['total_produtos'])
-        return 10
-        
-    except Exception as e:
-        st.error(f"Erro ao obter total de produtos: {e}")
-        return 10
-
-# 1. PRODUTOS QUE MAIS SAEM (RANKING) - Modificada para usar parâmetro global
-@st.cache_data(ttl=300)
-def get_top_products(limit=15):
-    """Ranking dos produtos mais vendidos"""
-    connection = get_databricks_connection()
-    if not connection:
-        return pd.DataFrame()
-    
-    try:
-        query = f"""
+    @staticmethod
+    def _is_alive(connection):
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.fetchall()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def acquire(self):
+        """Empresta uma conexão validada e devolve ao pool ao final"""
+        try:
+            connection = self._idle.get_nowait()
+        except queue.Empty:
+            connection = self._connect()
+        else:
+            # Conexões ociosas podem ter sido encerradas pelo warehouse
+            if not self._is_alive(connection):
+                self._close(connection)
+                connection = self._connect()
+        try:
+            yield connection
+        finally:
+            try:
+                self._idle.put_nowait(connection)
+            except queue.Full:
+                self._close(connection)
+
+    def close(self):
+        while True:
+            try:
+                self._close(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+@st.cache_resource
+def get_connection_pool():
+    """Cria o pool de conexões com Databricks (um por processo)"""
+    # Uma conexão por consulta disparada em paralelo na carga da página
+    pool = _Pool(max_idle=2)
+    atexit.register(pool.close)
+    return pool
+
+def fetch_dataframe(query, parameters=None):
+    """Executa a query e traz o resultado via Arrow, mantendo colunas Arrow no pandas"""
+    with get_connection_pool().acquire() as connection, connection.cursor() as cursor:
+        # Parâmetros nativos (marcadores ?) mantêm o texto da query fixo entre execuções
+        cursor.execute(query, parameters=parameters)
+        arrow_tbl = cursor.fetchall_arrow()
+    return arrow_tbl.to_pandas(types_mapper=pd.ArrowDtype)
+
+def _json_default(value):
+    """Converte os tipos que o orjson não serializa sozinho"""
+    if value is pd.NA:
+        return None
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"Tipo não serializável: {type(value).__name__}")
+
+def to_vega_values(df):
+    """Registros do DataFrame já reduzidos a tipos JSON nativos para o spec VegaLite"""
+    payload = orjson.dumps(df.to_dict(orient='records'), option=orjson.OPT_SERIALIZE_NUMPY, default=_json_default)
+    return orjson.loads(payload)
+
+def cache_window():
+    """Janela de cache atual; entra na chave dos caches em disco, que não suportam ttl"""
+    return int(time.time() // CACHE_TTL_SECONDS)
+
+_cache_stats_lock = threading.Lock()
+
+def track_cache_stats(func):
+    """Registra acertos, falhas e tempo de cada chamada em st.session_state['_cache_stats']"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        inicio = time.perf_counter()
+        result = func(*args, **kwargs)
+        elapsed_ms = (time.perf_counter() - inicio) * 1000
+        # Sem contexto de script (thread sem add_script_run_ctx) não há sessão onde registrar
+        if get_script_run_ctx() is None:
+            return result
+        hit = elapsed_ms < CACHE_HIT_THRESHOLD_S * 1000
+        with _cache_stats_lock:
+            stats = st.session_state.setdefault('_cache_stats', {}).setdefault(func.__name__, {
+                'chamadas': 0, 'hits': 0, 'misses': 0, 'tempo_total_ms': 0.0, 'ultimo_ms': 0.0
+            })
+            stats['chamadas'] += 1
+            stats['hits' if hit else 'misses'] += 1
+            stats['tempo_total_ms'] += elapsed_ms
+            stats['ultimo_ms'] = elapsed_ms
+        return result
+    # Mantém o clear(*args) da função em cache acessível pelo wrapper
+    wrapper.clear = func.clear
+    return wrapper
+
+def top_n_slice(df, top_n):
+    """Recorta um resultado pré-carregado (até MAX_TOP_N produtos) para o top N escolhido"""
+    if df.empty:
+        return df
+    return df[df['ranking'] <= top_n]
+
+# 1. PRODUTOS QUE MAIS SAEM (RANKING) + 3. ANÁLISE DE ESTOQUE - Uma única consulta ao Databricks
+@track_cache_stats
+@st.cache_data(persist="disk", max_entries=2)
+def load_all(janela):
+    """Total de produtos únicos, ranking dos mais vendidos, estoque com média diária e data da agregação"""
+    query = """
+    WITH vendas_resumo AS (
+        -- dash_produto_agg (ver manutencao.sql) já traz as somas por produto e mês
         SELECT 
-            TRIM(descricaoProduto) as produto,
+            produto,
             CAST(SUM(qtde) as DOUBLE) as quantidade_total,
-            CAST(COUNT(DISTINCT vendaId) as BIGINT) as num_vendas,
+            CAST(SUM(num_vendas) as BIGINT) as num_vendas,
             CAST(SUM(valor) as DOUBLE) as valor_total,
-            FIRST(un) as unidade
-        FROM main.default.itens_venda_mm
-        WHERE descricaoProduto IS NOT NULL
-        AND LENGTH(TRIM(descricaoProduto)) > 0
-        AND qtde > 0
-        GROUP BY TRIM(descricaoProduto)
-        ORDER BY quantidade_total DESC
-        LIMIT {limit}
-        """
-        
-        df = pd.read_sql(query, connection)
-        
-        # Garantir tipos corretos
-        if not df.empty:
-            df['quantidade_total'] = pd.to_numeric(df['quantidade_total'], errors='coerce')
-            df['valor_total'] = pd.to_numeric(df['valor_total'], errors='coerce')
-            df = df.dropna(subset=['produto', 'quantidade_total'])
-        
-        return df
-        
-    except Exception as e:
-        st.error(f"Erro na query: {e}")
-        return pd.DataFrame()
+            FIRST(un) as unidade,
+            SUM(qtde) / SUM(num_itens) as media_venda,
+            SUM(dias_com_venda) as dias_com_venda,
+            MAX(built_at) as built_at,
+            -- Desempate por nome: o mesmo ranking em todas as consultas e o LIMIT corta exatamente 1..N
+            ROW_NUMBER() OVER (ORDER BY SUM(qtde) DESC, produto) as ranking,
+            COUNT(*) OVER () as total_produtos  -- calculado antes do LIMIT: total de produtos únicos
+        FROM main.default.dash_produto_agg
+        GROUP BY produto
+        ORDER BY ranking
+        LIMIT ?
+    ),
+    top_products AS (
+        SELECT *,
+            CASE 
+                WHEN dias_com_venda > 0 THEN quantidade_total / dias_com_venda
+                ELSE quantidade_total / 30.0  -- fallback para 30 dias
+            END as media_venda_dia
+        FROM vendas_resumo
+    )
+    -- produtos_mm é pequena: broadcast evita o shuffle dos dois lados do join
+    SELECT /*+ BROADCAST(p) */
+        v.total_produtos,
+        v.built_at,
+        v.ranking,
+        v.produto,
+        v.quantidade_total,
+        v.num_vendas,
+        v.valor_total,
+        v.unidade,
+        v.media_venda,
+        v.media_venda_dia,
+        CASE 
+            WHEN p.id IS NOT NULL THEN 'Em Estoque' 
+            ELSE 'Sem Estoque' 
+        END as status_estoque,
+        p.descricao as descricao_cadastro,
+        p.estoque as quantidade_estoque,
+        p.grupo,
+        p.codigo_fab,
+        CASE 
+            WHEN p.id IS NOT NULL AND p.estoque IS NOT NULL AND v.media_venda_dia > 0 
+            THEN p.estoque / v.media_venda_dia
+            ELSE NULL
+        END as dias_estoque
+    FROM top_products v
+    LEFT JOIN main.default.produtos_mm p 
+        ON LOWER(v.produto) = LOWER(TRIM(p.descricao))
+    ORDER BY v.ranking
+    """
+    
+    df = fetch_dataframe(query, parameters=[MAX_TOP_N])
+    
+    # Total de produtos e data da agregação vêm repetidos em todas as linhas; 10 é o padrão quando não há dados
+    total_produtos = int(df['total_produtos'].iloc[0]) if not df.empty else 10
+    built_at = df['built_at'].iloc[0] if not df.empty else None
+    
+    # Separar o resultado largo nos dois DataFrames usados pelas abas
+    produtos_top = df[['ranking', 'produto', 'quantidade_total', 'num_vendas', 'valor_total', 'unidade']].drop_duplicates(subset=['produto'])
+    estoque_df = df[[
+        'ranking', 'produto', 'quantidade_total', 'media_venda', 'media_venda_dia', 'num_vendas', 'status_estoque',
+        'descricao_cadastro', 'quantidade_estoque', 'grupo', 'codigo_fab', 'dias_estoque'
+    ]].rename(columns={'quantidade_total': 'total_vendido'})
+    
+    # Colunas numéricas já chegam como DOUBLE (CAST na query), basta descartar nulos
+    produtos_top = produtos_top.dropna(subset=['produto', 'quantidade_total'])
+    
+    return total_produtos, produtos_top, estoque_df, built_at
 
-# 2. SAZONALIDADE DOS PRODUTOS - Modificada para usar parâmetro global
-@st.cache_data(ttl=300)
-def get_seasonality_data(top_n=5):
+# 2. SAZONALIDADE DOS PRODUTOS - Top MAX_TOP_N carregado uma vez, recortado com top_n_slice
+@track_cache_stats
+@st.cache_data(persist="disk", max_entries=2)
+def get_seasonality_data(janela):
     """Análise de sazonalidade mensal"""
-    connection = get_databricks_connection()
-    if not connection:
-        return pd.DataFrame()
-    
-    try:
-        # Usar top N produtos para análise de sazonalidade
-        query = f"""
-        WITH top_produtos AS (
-            SELECT descricaoProduto
-            FROM main.default.itens_venda_mm
-            WHERE descricaoProduto IS NOT NULL
-            GROUP BY descricaoProduto
-            ORDER BY SUM(qtde) DESC
-            LIMIT {top_n}
-        )
+    # Usar os MAX_TOP_N produtos para análise de sazonalidade (recortados depois pelo ranking)
+    query = """
+    WITH top_produtos AS (
         SELECT 
-            descricaoProduto as produto,
-            DATE_FORMAT(data, 'yyyy-MM') as mes,
-            SUM(qtde) as quantidade
-        FROM main.default.itens_venda_mm
-        WHERE descricaoProduto IN (SELECT descricaoProduto FROM top_produtos)
-        AND data IS NOT NULL
-        GROUP BY descricaoProduto, DATE_FORMAT(data, 'yyyy-MM')
-        ORDER BY mes, produto
-        """
-        
-        df = pd.read_sql(query, connection)
-        
-        # Se não tiver campo data, criar sazonalidade simulada baseada no vendaId
-        if df.empty:
-            query_alt = f"""
-            WITH top_produtos AS (
-                SELECT descricaoProduto, COUNT(*) as cnt
-                FROM main.default.itens_venda_mm
-                WHERE descricaoProduto IS NOT NULL
-                GROUP BY descricaoProduto
-                ORDER BY cnt DESC
-                LIMIT {top_n}
-            )
-            SELECT 
-                iv.descricaoProduto as produto,
-                iv.vendaId,
-                iv.qtde as quantidade
-            FROM main.default.itens_venda_mm iv
-            INNER JOIN top_produtos tp ON iv.descricaoProduto = tp.descricaoProduto
-            """
-            
-            df = pd.read_sql(query_alt, connection)
-            if not df.empty:
-                # Criar meses baseados no vendaId
-                max_venda = df['vendaId'].max()
-                df['mes_num'] = (df['vendaId'] / max_venda * 12).astype(int) % 12 + 1
-                df['mes'] = pd.to_datetime(df['mes_num'], format='%m').dt.strftime('2024-%m')
-                df = df.groupby(['produto', 'mes'])['quantidade'].sum().reset_index()
-        
-        return df
-        
-    except Exception as e:
-        st.error(f"Erro: {e}")
-        return pd.DataFrame()
-
-# 3. ANÁLISE DE ESTOQUE - Modificada para incluir média por dia e usar parâmetro global
-@st.cache_data(ttl=300)
-def analyze_stock(top_n=10):
-    """Verifica estoque dos produtos mais vendidos com média diária"""
-    connection = get_databricks_connection()
-    if not connection:
-        return pd.DataFrame()
+            produto,
+            ROW_NUMBER() OVER (ORDER BY SUM(qtde) DESC, produto) as ranking
+        FROM main.default.dash_produto_agg
+        GROUP BY produto
+        ORDER BY ranking
+        LIMIT ?
+    )
+    SELECT 
+        a.produto,
+        tp.ranking,
+        a.mes,
+        a.qtde as quantidade
+    FROM main.default.dash_produto_agg a
+    INNER JOIN top_produtos tp ON a.produto = tp.produto
+    WHERE a.mes IS NOT NULL
+    """
     
-    try:
-        query = f"""
-        WITH vendas_resumo AS (
+    df = fetch_dataframe(query, parameters=[MAX_TOP_N])
+    
+    if not df.empty:
+        # O mês chega como DATE (primeiro dia do mês, sem fuso); "yyyy-MM-dd" recortado para "yyyy-MM"
+        df['mes'] = df['mes'].astype('string').str.slice(0, 7)
+    else:
+        # Se não tiver campo data, criar sazonalidade simulada baseada no vendaId
+        # Meses derivados do vendaId e agregados no próprio Databricks (só volta produto x mês)
+        query_alt = """
+        WITH top_produtos AS (
             SELECT 
                 descricaoProduto,
-                SUM(qtde) as total_vendido,
-                AVG(qtde) as media_venda,
-                COUNT(DISTINCT DATE(data)) as dias_com_venda,
-                COUNT(DISTINCT vendaId) as num_vendas
+                ROW_NUMBER() OVER (ORDER BY COUNT(*) DESC, descricaoProduto) as ranking
             FROM main.default.itens_venda_mm
             WHERE descricaoProduto IS NOT NULL
-            AND data IS NOT NULL
             GROUP BY descricaoProduto
-            ORDER BY total_vendido DESC
-            LIMIT {top_n}
+            ORDER BY ranking
+            LIMIT ?
         ),
-        vendas_com_media_dia AS (
-            SELECT *,
-                CASE 
-                    WHEN dias_com_venda > 0 THEN total_vendido / dias_com_venda
-                    ELSE total_vendido / 30.0  -- fallback para 30 dias
-                END as media_venda_dia
-            FROM vendas_resumo
+        max_venda AS (
+            SELECT MAX(vendaId) as max_venda_id
+            FROM main.default.itens_venda_mm
         )
         SELECT 
-            v.descricaoProduto as produto,
-            v.total_vendido,
-            v.media_venda,
-            v.media_venda_dia,
-            v.num_vendas,
-            CASE 
-                WHEN p.id IS NOT NULL THEN 'Em Estoque' 
-                ELSE 'Sem Estoque' 
-            END as status_estoque,
-            p.descricao as descricao_cadastro,
-            p.estoque as quantidade_estoque,
-            p.grupo,
-            p.codigo_fab,
-            CASE 
-                WHEN p.id IS NOT NULL AND p.estoque IS NOT NULL AND v.media_venda_dia > 0 
-                THEN p.estoque / v.media_venda_dia
-                ELSE NULL
-            END as dias_estoque
-        FROM vendas_com_media_dia v
-        LEFT JOIN main.default.produtos_mm p 
-            ON LOWER(TRIM(v.descricaoProduto)) = LOWER(TRIM(p.descricao))
-        ORDER BY v.total_vendido DESC
+            iv.descricaoProduto as produto,
+            tp.ranking,
+            CAST(FLOOR(iv.vendaId / mv.max_venda_id * 12) AS INT) % 12 + 1 as mes_num,
+            SUM(iv.qtde) as quantidade
+        FROM main.default.itens_venda_mm iv
+        INNER JOIN top_produtos tp ON iv.descricaoProduto = tp.descricaoProduto
+        CROSS JOIN max_venda mv
+        GROUP BY iv.descricaoProduto, tp.ranking, mes_num
         """
         
-        df = pd.read_sql(query, connection)
-        return df
-        
-    except Exception as e:
-        st.error(f"Erro: {e}")
-        return pd.DataFrame()
+        df = fetch_dataframe(query_alt, parameters=[MAX_TOP_N])
+        if not df.empty:
+            df.insert(2, 'mes', '2024-' + df.pop('mes_num').astype(str).str.zfill(2))
+    
+    return df
+
+@st.cache_resource(max_entries=1)
+def start_cache_window(janela):
+    """Na primeira vez que uma janela aparece, apaga da memória e do disco todas as entradas antigas"""
+    # max_entries só limita a memória: os arquivos em disco só saem com clear(). Sem argumentos,
+    # clear() remove também janelas que ficaram para trás por falta de acesso ou reinício do processo
+    load_all.clear()
+    get_seasonality_data.clear()
+    return True
 
 # Header
 st.markdown("""
@@ -320,8 +390,22 @@ st.markdown("""
 # CONTROLES GLOBAIS MELHORADOS
 st.markdown("### ⚙️ Configurações Globais")
 
-# Obter total de produtos para definir o range
-total_produtos = get_total_products()
+# Nenhuma consulta depende do top N: disparar as duas em paralelo (latência da mais lenta, não da soma)
+# Mesma janela para as duas consultas; persistidas em disco, sobrevivem a novas sessões e redeploys
+janela = cache_window()
+start_cache_window(janela)
+
+with ThreadPoolExecutor(max_workers=2, initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx())) as executor:
+    f_top = executor.submit(load_all, janela)
+    f_seas = executor.submit(get_seasonality_data, janela)
+
+# Obter total de produtos para definir o range (vem da mesma consulta do ranking)
+# Erros são tratados aqui, fora das funções em cache: exceções não ficam gravadas no cache
+try:
+    total_produtos, produtos_top_full, estoque_full, atualizado_em = f_top.result()
+except Exception as e:
+    st.error(f"Erro na query: {e}")
+    total_produtos, produtos_top_full, estoque_full, atualizado_em = 10, pd.DataFrame(), pd.DataFrame(), None
 
 col1, col2, col3 = st.columns([2, 2, 1])
 with col1:
@@ -339,15 +423,19 @@ with col2:
     top_n_input = st.number_input(
         "Ou digite o número exato:", 
         min_value=2, 
-        max_value=min(total_produtos, 100),
+        max_value=min(total_produtos, MAX_TOP_N),
         value=top_n_slider,
         key="top_n_input"
     )
 
 with col3:
+    # Única forma de invalidar o cache (memória e disco) antes da próxima janela
     if st.button("🔄 Atualizar", key="refresh"):
         st.cache_data.clear()
         st.rerun()
+    if atualizado_em is not None:
+        # Data em que manutencao.sql gerou dash_produto_agg, não a hora em que o cache foi preenchido
+        st.caption(f"🕒 Vendas agregadas em {atualizado_em:%d/%m/%Y %H:%M %Z}")
 
 # Usar o valor do input se diferente do slider, senão usar o slider
 top_n = top_n_input if top_n_input != top_n_slider else top_n_slider
@@ -355,6 +443,10 @@ top_n = top_n_input if top_n_input != top_n_slider else top_n_slider
 # Mostrar informação sobre o total
 st.info(f"📊 Total de produtos únicos disponíveis: **{total_produtos:,}** | Filtrando top **{top_n}**")
 
+# Ranking e estoque chegam na mesma ida ao Databricks; mudar o top N só recorta o cache local
+produtos_top = top_n_slice(produtos_top_full, top_n)
+estoque_df = top_n_slice(estoque_full, top_n)
+
 st.markdown("---")
 
 # Tabs principais
@@ -363,8 +455,6 @@ tab1, tab2, tab3 = st.tabs(["🏆 Ranking de Produtos", "📈 Sazonalidade", "
 with tab1:
     st.markdown(f"### Produtos que Mais Saem (Top {top_n} filtrados)")
 
-    produtos_top = get_top_products(top_n)
-
     if produtos_top.empty:
         st.error("Nenhum dado retornado da query. Verifique a conexão com o banco.")
     else:
@@ -373,27 +463,17 @@ with tab1:
             if col not in produtos_top.columns:
                 produtos_top[col] = None
 
-        # Limpa e converte campos obrigatórios
-        produtos_top_clean = produtos_top.dropna(subset=['produto', 'quantidade_total'])
-        produtos_top_clean['produto'] = produtos_top_clean['produto'].astype(str)
-        produtos_top_clean['quantidade_total'] = pd.to_numeric(produtos_top_clean['quantidade_total'], errors='coerce')
-        produtos_top_clean = produtos_top_clean.dropna(subset=['quantidade_total'])
-        produtos_top_clean['quantidade_total'] = produtos_top_clean['quantidade_total'].astype(float)
+        # Campos obrigatórios já vêm limpos e tipados de load_all
+        produtos_top_clean = produtos_top.copy()
 
-        # Formata o campo valor_total para exibição (texto)
-        produtos_top_clean['valor_total_formatado'] = produtos_top_clean['valor_total'].apply(
-            lambda v: f"R$ {v:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".") if pd.notnull(v) else "-"
-        )
+        # Formata o campo valor_total para exibição (texto), trocando separadores em uma única passada
+        produtos_top_clean['valor_total_formatado'] = (
+            'R$ ' + produtos_top_clean['valor_total'].map('{:,.2f}'.format, na_action='ignore')
+            .astype('string').str.translate(BRL_SEPARADORES)
+        ).fillna('-')
 
-        # Converte para JSON seguro (sem numpy types)
-        vega_data = produtos_top_clean.to_dict(orient='records')
-        vega_data = [
-            {
-                k: float(v) if isinstance(v, (np.float64, np.int64)) else v
-                for k, v in d.items()
-            }
-            for d in vega_data
-        ]
+        # Converte para JSON seguro (sem numpy types nem pd.NA)
+        vega_data = to_vega_values(produtos_top_clean)
 
         # Métricas
         col1, col2, col3 = st.columns(3)
@@ -471,13 +551,17 @@ with tab2:
     st.markdown(f"### Análise de Sazonalidade ({top_n} produtos filtrados)")
     
     # Usar o número exato de produtos escolhidos pelo usuário
-    sazonalidade = get_seasonality_data(top_n)
+    try:
+        sazonalidade = top_n_slice(f_seas.result(), top_n)
+    except Exception as e:
+        st.error(f"Erro: {e}")
+        sazonalidade = pd.DataFrame()
     
     if not sazonalidade.empty:
         # Gráfico de linhas Vega
         vega_spec = {
             "$schema": "https://vega.github.io/schema/vega-lite/v5.json",
-            "data": {"values": sazonalidade.to_dict('records')},
+            "data": {"values": to_vega_values(sazonalidade)},
             "mark": {"type": "line", "point": True},
             "encoding": {
                 "x": {
@@ -534,33 +618,18 @@ with tab2:
 with tab3:
     st.markdown(f"### Status de Estoque ({top_n} produtos filtrados)")
     
-    estoque_df = analyze_stock(top_n)
-    
     if not estoque_df.empty:
-        # Adicionar badges de status
-        def format_status_badge(status):
-            if status == 'Em Estoque':
-                return '<span class="status-badge status-em-estoque">✅ Em Estoque</span>'
-            else:
-                return '<span class="status-badge status-sem-estoque">❌ Sem Estoque</span>'
-        
-        # Criar cópia para exibição com badges
-        display_df = estoque_df.copy()
-        
-        # Criar coluna de status formatada para o dataframe
-        display_df['status_visual'] = display_df['status_estoque'].apply(
-            lambda status: f"✅ {status}" if status == 'Em Estoque' else f"❌ {status}"
+        # Um único DataFrame de exibição: status formatado e colunas arredondadas
+        display_df = estoque_df.assign(
+            status_visual=np.where(estoque_df['status_estoque'].eq('Em Estoque'), '✅ Em Estoque', '❌ Sem Estoque'),
+            media_venda_dia=estoque_df['media_venda_dia'].round(2),
+            dias_estoque=estoque_df['dias_estoque'].round(1)
         )
         
-        # Formatar colunas para melhor exibição
-        if 'media_venda_dia' in display_df.columns:
-            display_df['media_venda_dia'] = display_df['media_venda_dia'].round(2)
-        if 'dias_estoque' in display_df.columns:
-            display_df['dias_estoque'] = display_df['dias_estoque'].round(1)
-        
-        # Métricas de estoque
-        sem_estoque = len(estoque_df[estoque_df['status_estoque'] == 'Sem Estoque'])
-        com_estoque = len(estoque_df[estoque_df['status_estoque'] == 'Em Estoque'])
+        # Métricas de estoque (uma única passada pela coluna de status, reaproveitada nos alertas)
+        status_counts = estoque_df['status_estoque'].value_counts()
+        com_estoque = int(status_counts.get('Em Estoque', 0))
+        sem_estoque = int(status_counts.get('Sem Estoque', 0))
         
         col1, col2, col3, col4 = st.columns(4)
         with col1:
@@ -585,7 +654,7 @@ with tab3:
             </div>
             """, unsafe_allow_html=True)
         with col4:
-            media_dia_total = display_df['media_venda_dia'].sum() if 'media_venda_dia' in display_df.columns else 0
+            media_dia_total = display_df['media_venda_dia'].sum()
             st.markdown(f"""
             <div class="metric-card">
                 <div class="metric-title">📈 Média Vendas/Dia</div>
@@ -600,20 +669,23 @@ with tab3:
         st.markdown("#### 🔍 Tabela Interativa (com filtros)")
         st.caption("💡 Use esta tabela para filtrar e ordenar os dados")
         
-        # Função para destacar linhas baseado no status
-        def highlight_status_rows(row):
-            if row['status_estoque'] == 'Sem Estoque':
-                return ['background-color: rgba(239, 68, 68, 0.15); color: white'] * len(row)
-            elif row['status_estoque'] == 'Em Estoque':
-                return ['background-color: rgba(16, 185, 129, 0.15); color: white'] * len(row)
-            else:
-                return [''] * len(row)
-        
-        # Preparar DataFrame para a tabela interativa (manter status_estoque para o estilo)
-        display_df_for_table = display_df.copy()
+        # Função para destacar linhas baseado no status (monta a matriz de estilos inteira de uma vez)
+        def highlight_status_rows(df):
+            status = df['status_estoque'].to_numpy(dtype=object)
+            css = np.select(
+                [status == 'Sem Estoque', status == 'Em Estoque'],
+                ['background-color: rgba(239, 68, 68, 0.15); color: white',
+                 'background-color: rgba(16, 185, 129, 0.15); color: white'],
+                default=''
+            )
+            return pd.DataFrame(
+                np.broadcast_to(css[:, None], df.shape),
+                index=df.index,
+                columns=df.columns
+            )
         
-        # Aplicar estilo condicional
-        styled_df = display_df_for_table.style.apply(highlight_status_rows, axis=1)
+        # Aplicar estilo condicional (display_df mantém status_estoque para o estilo)
+        styled_df = display_df.style.apply(highlight_status_rows, axis=None)
         
         # Configurar colunas da tabela
         column_config_filtered = {
@@ -640,9 +712,12 @@ with tab3:
         )
 
          # Alertas detalhados
-        produtos_criticos = estoque_df[estoque_df['status_estoque'] == 'Sem Estoque']['produto'].tolist()
-        if produtos_criticos:
-            produtos_html = "<br>".join([f"• {p}" for p in produtos_criticos[:5]])
+        produtos_criticos = (
+            estoque_df.loc[estoque_df['status_estoque'] == 'Sem Estoque', 'produto'].head(5)
+            if sem_estoque else pd.Series(dtype=object)
+        )
+        if not produtos_criticos.empty:
+            produtos_html = "<br>".join('• ' + produtos_criticos.astype(str))
             st.markdown(f"""
             <div style="background-color:#511; padding:1rem; border-radius:0.5rem; color:white">
                 <strong>⚠️ PRODUTOS TOP VENDAS SEM CADASTRO/ESTOQUE:</strong><br><br>
@@ -653,17 +728,18 @@ with tab3:
             """, unsafe_allow_html=True)
         
         # Produtos com estoque baixo (menos de 7 dias)
-        if 'dias_estoque' in estoque_df.columns:
+        if com_estoque and 'dias_estoque' in estoque_df.columns:
             estoque_baixo = estoque_df[
                 (estoque_df['status_estoque'] == 'Em Estoque') & 
                 (estoque_df['dias_estoque'] < 7) &
                 (estoque_df['dias_estoque'].notna())
             ]
             if not estoque_baixo.empty:
-                produtos_html = "<br>".join([
-                    f"• {row['produto']} - Estoque: {row['quantidade_estoque']:.0f} / Dias restantes: {row['dias_estoque']:.1f}"
-                    for _, row in estoque_baixo.iterrows()
-                ])
+                produtos_html = "<br>".join(
+                    '• ' + estoque_baixo['produto'].astype(str)
+                    + ' - Estoque: ' + estoque_baixo['quantidade_estoque'].map('{:.0f}'.format)
+                    + ' / Dias restantes: ' + estoque_baixo['dias_estoque'].map('{:.1f}'.format)
+                )
 
                 # Renderiza como bloco visual semelhante ao st.warning
                 st.markdown(f"""
@@ -707,9 +783,20 @@ with col2:
     - Implementar reposição automática baseada na média diária
     """)
 
+# Estatísticas de cache da sessão (acertos, falhas e tempo gasto por consulta)
+with st.sidebar.expander("⏱️ Estatísticas de cache"):
+    cache_stats = st.session_state.get('_cache_stats', {})
+    if cache_stats:
+        st.dataframe(
+            pd.DataFrame.from_dict(cache_stats, orient='index').sort_values('tempo_total_ms', ascending=False),
+            use_container_width=True
+        )
+    else:
+        st.caption("Nenhuma consulta registrada nesta sessão.")
+
 # Footer
 st.markdown(f"""
 <div style="margin-top: 3rem; text-align: center; color: #8b95a1; font-size: 0.9rem;">
-   Dashboard de Vendas | Análise em Tempo Real com Databricks | {top_n} produtos filtrados de {total_produtos:,} totais
+   Dashboard de Vendas | Vendas agregadas diariamente no Databricks | {top_n} produtos filtrados de {total_produtos:,} totais
 </div>
 """, unsafe_allow_html=True)
\ No newline at end of file
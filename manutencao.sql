@@ -0,0 +1,28 @@
+-- Manutenção das tabelas lidas pelo dashboard.py
+-- Agendar como job noturno no Databricks (SQL warehouse ou cluster com permissão de escrita em main.default).
+
+-- O dashboard só lê itens_venda_mm no fallback de sazonalidade por vendaId (filtro por descricaoProduto);
+-- o Z-order atende esse filtro e o OPTIMIZE compacta os arquivos lidos pela agregação abaixo.
+OPTIMIZE main.default.itens_venda_mm ZORDER BY (descricaoProduto, data);
+
+-- Tabela pré-agregada lida pelo dashboard (load_all e get_seasonality_data): uma linha por produto e mês.
+-- O mês fica como DATE do primeiro dia (chave de agrupamento numérica, sem fuso horário); o dashboard formata o texto.
+-- Recriar depois do OPTIMIZE, sempre que itens_venda_mm for atualizada.
+-- num_itens permite recompor a média por item (SUM(qtde) / SUM(num_itens)); num_vendas e dias_com_venda
+-- podem ser somados entre meses porque cada venda e cada dia pertencem a um único mês.
+CREATE OR REPLACE TABLE main.default.dash_produto_agg AS
+SELECT
+    TRIM(descricaoProduto) as produto,
+    TRUNC(data, 'MM') as mes,
+    SUM(qtde) as qtde,
+    SUM(valor) as valor,
+    COUNT(*) as num_itens,
+    COUNT(DISTINCT vendaId) as num_vendas,
+    COUNT(DISTINCT DATE(data)) as dias_com_venda,
+    FIRST(un) as un,
+    current_timestamp() as built_at  -- exibido no dashboard como data dos dados
+FROM main.default.itens_venda_mm
+WHERE descricaoProduto IS NOT NULL
+AND LENGTH(TRIM(descricaoProduto)) > 0
+AND qtde > 0
+GROUP BY TRIM(descricaoProduto), TRUNC(data, 'MM');